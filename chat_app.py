@@ -1,5 +1,16 @@
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import json
 import os
+import queue
+import sqlite3
+import threading
+import time
 import traceback
+import numpy as np
 import streamlit as st
 from dotenv import load_dotenv
 
@@ -9,113 +20,596 @@ load_dotenv()
 COHERE_API_KEY = os.getenv("COHERE_API_KEY")
 TAVILY_API_KEY = os.getenv("TAVILY_API_KEY")
 COHERE_MODEL = os.getenv("COHERE_MODEL", "command-a-03-2025")  # ✅ correct default
+COHERE_EMBED_MODEL = os.getenv("COHERE_EMBED_MODEL", "embed-english-light-v3.0")
+COHERE_MAX_CONCURRENCY = 5  # in-flight chat calls across all sessions
+WORKER_THREADS = 8
+HISTORY_SIZE = 50  # Q&A turns kept per session
+HTTP_TIMEOUT = 300.0  # seconds; generous enough for long chat completions
+
+# Per-provider request (rpm) and token (tpm) budgets per minute
+RATE_LIMITS = {
+    "cohere": {"rpm": 60, "tpm": 150_000},
+    "tavily": {"rpm": 60},
+}
+RATE_LIMIT_RETRIES = 3
+
+SEMANTIC_CACHE_THRESHOLD = 0.92  # cosine similarity counted as the same question
+SEMANTIC_CACHE_SIZE = 500
+EMBED_BATCH_SIZE = 96  # Cohere's per-call limit for embed texts
+EMBED_BATCH_DELAY = 0.02  # seconds to wait for more questions before flushing
+
+SEARCH_CACHE_TTL = 24 * 60 * 60  # seconds a web search result is reused
+ANSWER_CACHE_TTL = 60 * 60  # seconds a generated answer is reused
+CACHE_DB_PATH = os.getenv(
+    "RESEARCH_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "research.sqlite3"),
+)
+
+SOURCE_CONTENT_CHARS = 400  # per-source content sent to the model
+PROMPT_TOKEN_BUDGET = 2048  # soft cap, estimated as len(prompt) // 4
+_NL_TABLE = str.maketrans({"\n": " ", "\r": " "})
+_PROMPT_TAIL = "Be factual and cite the sources inline as [1], [2], etc."
 
 
 # --------------------------
 # Initialize API Clients
 # --------------------------
+def _pooled_http_client():
+    import httpx
+
+    # Keep-alive pool so consecutive calls reuse an open TLS connection; the
+    # transport also retries failed connection attempts.
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=20),
+    )
+    return httpx.AsyncClient(transport=transport, timeout=httpx.Timeout(HTTP_TIMEOUT, connect=10.0))
+
+
 @st.cache_resource
 def init_clients():
     try:
         import cohere
-        from tavily import TavilyClient
+        from tavily import AsyncTavilyClient
     except ImportError as e:
-        st.error("Missing packages: install with `pip install cohere tavily-python`")
+        st.error("Missing packages: install with `pip install cohere tavily-python httpx[http2]`")
         raise
 
     if not COHERE_API_KEY or not TAVILY_API_KEY:
         st.error("⚠️ Missing COHERE_API_KEY or TAVILY_API_KEY in .env file.")
         st.stop()
 
-    co = cohere.Client(COHERE_API_KEY)
-    tv = TavilyClient(api_key=TAVILY_API_KEY)
+    # One pool per provider: Tavily writes its auth header and base URL onto
+    # the client it is given, so the two must not share a client.
+    # max_retries=0: the SDK's own retries would bypass the rate limiter,
+    # so _call_with_backoff handles them instead
+    co = cohere.AsyncClient(
+        COHERE_API_KEY, timeout=HTTP_TIMEOUT, max_retries=0, httpx_client=_pooled_http_client()
+    )
+    tv = AsyncTavilyClient(api_key=TAVILY_API_KEY, client=_pooled_http_client())
     return co, tv
 
 
+# --------------------------
+# Async Runtime
+# --------------------------
+@st.cache_resource
+def _event_loop():
+    # One long-lived loop per server process: the cached async clients keep
+    # connection pools bound to the loop they first ran on, so every call
+    # must be scheduled here rather than on a fresh asyncio.run() loop.
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="research-io", daemon=True).start()
+    return loop
+
+
+@st.cache_resource
+def _executor():
+    # Shared by every session, for the short search and embed jobs run
+    # alongside the script
+    return concurrent.futures.ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix="research-worker")
+
+
+@st.cache_resource
+def _cohere_semaphore():
+    return asyncio.Semaphore(COHERE_MAX_CONCURRENCY)
+
+
+def _run(coro):
+    """Run a coroutine on the shared event loop and block until it finishes."""
+    return asyncio.run_coroutine_threadsafe(coro, _event_loop()).result()
+
+
+# --------------------------
+# Rate Limiting
+# --------------------------
+class TokenBucket:
+    """Async limiter admitting `rpm` requests and, optionally, `tpm` tokens per minute."""
+
+    def __init__(self, rpm, tpm=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm or 0)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, tokens=1):
+        # A single call larger than the whole budget could never be admitted
+        tokens = min(tokens, self.tpm) if self.tpm else 0
+
+        async with self._lock:
+            while True:
+                self._refill()
+                request_wait = (1 - self._requests) * 60 / self.rpm
+                token_wait = (tokens - self._tokens) * 60 / self.tpm if self.tpm else 0
+                wait = max(request_wait, token_wait)
+                if wait <= 0:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep(wait)
+
+
+@st.cache_resource
+def _rate_limiter(provider):
+    return TokenBucket(**RATE_LIMITS[provider])
+
+
+def _retryable_errors():
+    from cohere import GatewayTimeoutError, InternalServerError, ServiceUnavailableError, TooManyRequestsError
+    from tavily import UsageLimitExceededError
+
+    return (
+        TooManyRequestsError,
+        UsageLimitExceededError,
+        InternalServerError,
+        ServiceUnavailableError,
+        GatewayTimeoutError,
+    )
+
+
+async def _call_with_backoff(provider, call, tokens=1):
+    """Await `call()` under the provider's rate limit, backing off on 429s and 5xx.
+
+    This is the only retry path: every attempt passes through the bucket.
+    """
+    limiter = _rate_limiter(provider)
+    for attempt in range(RATE_LIMIT_RETRIES):
+        await limiter.acquire(tokens)
+        try:
+            return await call()
+        except _retryable_errors():
+            if attempt == RATE_LIMIT_RETRIES - 1:
+                raise
+            await asyncio.sleep(2 ** attempt)
+
+
+# --------------------------
+# Disk Cache
+# --------------------------
+class DiskCache:
+    """sqlite table of JSON values that expire `ttl` seconds after being written.
+
+    Streamlit's own persist="disk" ignores `ttl` and never deletes its files,
+    so searches and answers that outlive a restart are stored here instead.
+    """
+
+    def __init__(self, path, table, ttl):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.table = table
+        self.ttl = ttl
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._prune()
+
+    def _prune(self):
+        self._conn.execute(f"DELETE FROM {self.table} WHERE created < ?", (time.time() - self.ttl,))
+
+    def get(self, key):
+        """Return the stored value, or None if it is missing or expired."""
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, created FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, created) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time()),
+            )
+            # Expired rows go on every write, which keeps the file bounded
+            self._prune()
+
+
+@st.cache_resource
+def _disk_cache(table, ttl):
+    return DiskCache(CACHE_DB_PATH, table, ttl)
+
+
+# --------------------------
+# Semantic Cache
+# --------------------------
+class SemanticCache:
+    """FIFO-bounded answers, looked up by cosine similarity of question embeddings.
+
+    Entries older than `max_age` seconds are ignored, matching the lifetime
+    of the answer cache this sits in front of. A hit skips the Cohere chat
+    call; the web search is started in parallel with the lookup and still
+    runs (see _stream_search_and_answer).
+    """
+
+    def __init__(self, threshold=SEMANTIC_CACHE_THRESHOLD, max_entries=SEMANTIC_CACHE_SIZE, max_age=ANSWER_CACHE_TTL):
+        self.threshold = threshold
+        self.max_age = max_age
+        self._entries = collections.deque(maxlen=max_entries)
+        self._lock = threading.Lock()
+
+    def lookup(self, embedding):
+        """Return the cached result for the closest fresh question, if it is close enough."""
+        cutoff = time.monotonic() - self.max_age
+        with self._lock:
+            # FIFO order means expired entries are always at the front
+            while self._entries and self._entries[0][2] < cutoff:
+                self._entries.popleft()
+            entries = list(self._entries)
+        if not entries:
+            return None
+
+        sims = np.stack([e for e, _, _ in entries]) @ embedding
+        best = int(sims.argmax())
+        return entries[best][1] if sims[best] > self.threshold else None
+
+    def add(self, embedding, result):
+        with self._lock:
+            self._entries.append((embedding, result, time.monotonic()))
+
+
+@st.cache_resource
+def _semantic_cache():
+    return SemanticCache()
+
+
+class EmbedBatcher:
+    """Coalesce concurrent embedding requests into batched embed calls.
+
+    Must only be used from the shared event loop.
+    """
+
+    def __init__(self, embed, max_batch=EMBED_BATCH_SIZE, delay=EMBED_BATCH_DELAY):
+        self.embed = embed
+        self.max_batch = max_batch
+        self.delay = delay
+        self.pending = []
+        self._full = asyncio.Event()
+        self._flush_task = None
+
+    async def add(self, text):
+        """Return the embedding of `text`, computed in the next batch."""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((text, future))
+        if len(self.pending) >= self.max_batch:
+            self._full.set()
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush())
+        return await future
+
+    async def _flush(self):
+        try:
+            await asyncio.wait_for(self._full.wait(), self.delay)
+        except asyncio.TimeoutError:
+            pass
+
+        batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+        self._full.clear()
+        if len(self.pending) >= self.max_batch:
+            self._full.set()
+        # Requests that arrive while this batch is in flight start the next one
+        self._flush_task = asyncio.create_task(self._flush()) if self.pending else None
+
+        try:
+            embeddings = await self.embed([text for text, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        for (_, future), embedding in zip(batch, embeddings):
+            future.set_result(embedding)
+
+
+@st.cache_resource
+def _embed_batcher():
+    co_client, _ = init_clients()
+    return EmbedBatcher(lambda texts: _embed_async(co_client, texts))
+
+
+async def _embed_async(co_client, texts):
+    resp = await _call_with_backoff(
+        "cohere",
+        lambda: co_client.embed(texts=texts, model=COHERE_EMBED_MODEL, input_type="search_query"),
+        tokens=sum(len(t) for t in texts) // 4,
+    )
+    # L2-normalised, so a dot product is the cosine similarity
+    embeddings = np.asarray(resp.embeddings, dtype=np.float32)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
 # --------------------------
 # Main Research Logic
 # --------------------------
-def search_and_answer(question, co_client, tv_client):
+def _normalize_question(question):
+    """Cache key for a question; the APIs still receive the user's own wording."""
+    return question.strip().lower()
+
+
+def _sources_key(sources):
+    """Hashable (title, content) tuples of the source fields the prompt uses."""
+    # URLs stay out of the prompt; the Sources panel shows them instead
+    return tuple(
+        (
+            s.get("title", "No title").strip(),
+            s.get("content", "").translate(_NL_TABLE).strip()[:SOURCE_CONTENT_CHARS],
+        )
+        for s in sources
+    )
+
+
+def _format_prompt(question, sources_key):
+    context = "\n\n".join(
+        f"[{i}] {title}\n{content}" for i, (title, content) in enumerate(sources_key, start=1)
+    )
+    return f"Answer the question: {question}\n\nUse only these sources:\n\n{context}\n\n{_PROMPT_TAIL}"
+
+
+def _build_prompt(question, sources_key):
+    prompt = _format_prompt(question, sources_key)
+
+    # Over budget: shorten every source by the same fraction rather than
+    # dropping any of them
+    excess = len(prompt) - PROMPT_TOKEN_BUDGET * 4
+    content_chars = sum(len(content) for _, content in sources_key)
+    if excess > 0 and content_chars:
+        keep = max(0.0, 1 - excess / content_chars)
+        sources_key = tuple((title, content[:int(len(content) * keep)]) for title, content in sources_key)
+        prompt = _format_prompt(question, sources_key)
+
+    return prompt
+
+
+async def _tavily_search_async(tv_client, question, max_results):
+    search_result = await _call_with_backoff(
+        "tavily",
+        lambda: tv_client.search(query=question, search_depth="basic", max_results=max_results),
+    )
+    return search_result.get("results", []) if isinstance(search_result, dict) else []
+
+
+async def _cohere_answer_async(co_client, question, sources_key, on_text=None):
+    prompt = _build_prompt(question, sources_key)
+
+    async def stream_answer():
+        parts = []
+        async for event in co_client.chat_stream(model=COHERE_MODEL, message=prompt, temperature=0.3):
+            if event.event_type == "text-generation":
+                parts.append(event.text)
+                if on_text:
+                    on_text(event.text)
+        return "".join(parts)
+
+    async with _cohere_semaphore():
+        return await _call_with_backoff("cohere", stream_answer, tokens=len(prompt) // 4)
+
+
+# Both steps are cached in memory in front of an expiring DiskCache, so paid
+# lookups survive server restarts without being reused past their lifetime.
+@st.cache_data(ttl=SEARCH_CACHE_TTL, max_entries=1000, show_spinner=False)
+def _tavily_search(question_key, _question, max_results=5):
+    store = _disk_cache("tavily_search", SEARCH_CACHE_TTL)
+    key = f"{max_results}:{question_key}"
+    results = store.get(key)
+    if results is None:
+        _, tv_client = init_clients()
+        results = _run(_tavily_search_async(tv_client, _question, max_results))
+        store.set(key, results)
+    return results
+
+
+@st.cache_data(ttl=ANSWER_CACHE_TTL, max_entries=512, show_spinner=False)
+def _cohere_answer(question_key, sources_key, _question, _on_text=None):
+    # Keyed on exactly what goes into the prompt, so changed source content
+    # never reuses an answer written from an older version of the page.
+    # `_on_text` only receives chunks when Cohere is actually called.
+    store = _disk_cache("cohere_answer", ANSWER_CACHE_TTL)
+    key = hashlib.sha256(json.dumps([question_key, sources_key]).encode()).hexdigest()
+    answer = store.get(key)
+    if answer is None:
+        co_client, _ = init_clients()
+        answer = _run(_cohere_answer_async(co_client, _question, sources_key, _on_text))
+        store.set(key, answer)
+    return answer
+
+
+def _stream_cohere_answer(question_key, question, sources_key):
+    """Yield the answer as Cohere generates it; a cached answer arrives in one piece."""
+    chunks = queue.Queue()
+    done = object()
+
+    result = {}
+
+    def work():
+        try:
+            result["text"] = _cohere_answer(question_key, sources_key, question, _on_text=chunks.put)
+        except Exception as e:
+            result["error"] = e
+        finally:
+            chunks.put(done)
+
+    # A dedicated thread rather than the shared executor: a generation holds
+    # its thread for its whole length and would starve the short search and
+    # embed jobs that the executor exists for.
+    threading.Thread(target=work, name="cohere-stream", daemon=True).start()
+
+    streamed = False
+    while (chunk := chunks.get()) is not done:
+        streamed = True
+        yield chunk
+
+    if "error" in result:
+        raise result["error"]
+    if not streamed:
+        yield result["text"]
+
+
+def _stream_search_and_answer(question, co_client, tv_client, sources_out):
+    """Yield answer text for `question`, extending `sources_out` with the sources used."""
     if not co_client or not tv_client:
-        return "Missing API clients. Check API keys.", []
+        yield "Missing API clients. Check API keys."
+        return
+
+    question = question.strip()
+    question_key = _normalize_question(question)
+    cache = _semantic_cache()
+
+    # Start the web search while the question is embedded, so probing the
+    # semantic cache adds nothing to the miss path. The price is that every
+    # semantic hit still runs the search: one Tavily call and one slot of its
+    # rpm budget, unless this exact question is already in the search cache.
+    # The result is cached for later but unused here.
+    executor = _executor()
+    search = executor.submit(_tavily_search, question_key, question)
+    embed = executor.submit(_run, _embed_batcher().add(question))
+
+    try:
+        embedding = embed.result()
+    except Exception:
+        # The semantic cache is only a shortcut; answer without it
+        traceback.print_exc()
+        embedding = None
+
+    if embedding is not None:
+        cached = cache.lookup(embedding)
+        if cached is not None:
+            answer, sources = cached
+            sources_out.extend(sources)
+            yield answer
+            return
 
     try:
         # Step 1: Search the web
-        search_result = tv_client.search(query=question, search_depth="basic", max_results=5)
-        sources = search_result.get("results", []) if isinstance(search_result, dict) else []
+        sources = search.result()
 
         if not sources:
-            return "No information found on this topic.", []
-
-        # Step 2: Prepare search context
-        context_parts = []
-        for i, s in enumerate(sources, start=1):
-            title = s.get("title", "No title").strip()
-            url = s.get("url", "").strip()
-            content = s.get("content", "").replace("\n", " ").strip()[:800]
-            context_parts.append(f"[{i}] {title}\nURL: {url}\n{content}\n")
-
-        context = "\n\n".join(context_parts)
-
-        # Step 3: Prompt for Cohere Chat API
-        prompt = (
-            f"Answer the question: {question}\n\n"
-            "Use only the following sources and cite them inline as [1], [2], etc.\n\n"
-            f"{context}\n\n"
-            "Requirements:\n"
-            "- Be factual\n"
-            "- Cite sources using [n]\n"
-            "- Include a 'Sources' section with title and URL\n"
-        )
-
-        # Step 4: Call Cohere Chat API
-        resp = co_client.chat(model=COHERE_MODEL, message=prompt, temperature=0.3)
+            yield "No information found on this topic."
+            return
 
-        text = getattr(resp, "text", str(resp))
-        return text, sources
+        # Step 2: Stream the answer from the search context with Cohere
+        parts = []
+        for chunk in _stream_cohere_answer(question_key, question, _sources_key(sources)):
+            parts.append(chunk)
+            yield chunk
 
     except Exception as e:
         traceback.print_exc()
-        return f"⚠️ Error: {e}", []
+        yield f"⚠️ Error: {e}"
+        return
+
+    sources_out.extend(sources)
+    if embedding is not None:
+        cache.add(embedding, ("".join(parts), sources))
+
+
+def search_and_answer(question, co_client, tv_client):
+    sources = []
+    answer = "".join(_stream_search_and_answer(question, co_client, tv_client, sources))
+    return answer, sources
 
 
 # --------------------------
 # Streamlit App
 # --------------------------
+def _md_safe(text):
+    # Every source shares one markdown document, so a fence or HTML block
+    # left open by a cut-off snippet would swallow the rest of the panel
+    return text.replace("```", "").replace("~~~", "").replace("<", "&lt;")
+
+
+def _render_sources_md(sources):
+    """Format the Sources panel once, so reruns draw it with a single markdown call."""
+    blocks = []
+    for i, s in enumerate(sources, start=1):
+        blocks.append(f"**[{i}] {_md_safe(s.get('title', 'No title'))}**")
+        if s.get("url"):
+            blocks.append(s["url"])
+        if s.get("content"):
+            blocks.append(_md_safe(s.get("content", "")[:200]) + "...")
+        blocks.append("---")
+    return "\n\n".join(blocks)
+
+
+def _render_sources(item):
+    if item["rendered_sources_md"]:
+        with st.expander("Sources"):
+            st.markdown(item["rendered_sources_md"])
+
+
 def main():
     st.set_page_config(page_title="AI Research Assistant", layout="wide")
     st.title("🧠 AI Research Assistant")
     st.write("Ask a question — I’ll search the web and generate an answer with citations.")
 
     if "history" not in st.session_state:
-        st.session_state.history = []
+        st.session_state.history = collections.deque(maxlen=HISTORY_SIZE)
 
     co_client, tv_client = init_clients()
 
     question = st.text_input("Your research question")
 
+    new_item = None
     if st.button("Ask") and question.strip():
+        # The newest turn is streamed in place instead of drawn from history
+        st.markdown(f"### ❓ {question}")
+        sources = []
+        stream = _stream_search_and_answer(question, co_client, tv_client, sources)
+        # The spinner covers the search only; it clears once text starts arriving
         with st.spinner("Searching and generating answer..."):
-            answer, sources = search_and_answer(question, co_client, tv_client)
-            st.session_state.history.append({
-                "question": question,
-                "answer": answer,
-                "sources": sources
-            })
+            first_chunk = next(stream, "")
+        answer = st.write_stream(itertools.chain([first_chunk], stream))
+
+        new_item = {
+            "question": question,
+            "answer": answer,
+            # Only the rendered panel is kept; the raw Tavily results are not
+            "rendered_sources_md": _render_sources_md(sources),
+        }
+        _render_sources(new_item)
+        st.session_state.history.append(new_item)
 
     # Display previous Q&A
     for item in reversed(st.session_state.history):
+        if item is new_item:
+            continue
         st.markdown(f"### ❓ {item['question']}")
         st.markdown(item['answer'])
-        if item["sources"]:
-            with st.expander("Sources"):
-                for i, s in enumerate(item["sources"], start=1):
-                    st.markdown(f"**[{i}] {s.get('title', 'No title')}**")
-                    if s.get("url"):
-                        st.markdown(s["url"])
-                    if s.get("content"):
-                        st.markdown(s.get("content", "")[:200] + "...")
-                    st.markdown("---")
+        _render_sources(item)
 
 
 if __name__ == "__main__":